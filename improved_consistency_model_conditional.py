@@ -1,6 +1,6 @@
 import math
 from dataclasses import dataclass
-from typing import Any, Callable, Iterable, Optional, Tuple, Union, Iterator
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple, Union, Iterator
 
 import torch
 from torch import Tensor, nn
@@ -692,6 +692,87 @@ class ConsistencySamplingAndEditing:
 
         return x
 
+    def sample_schedules(
+        self,
+        model: nn.Module,
+        noise: Tensor,
+        v: Tensor,
+        sigmas_list: Sequence[Sequence[float]],
+        clip_denoised: bool = False,
+        **kwargs: Any,
+    ) -> List[Tensor]:
+        """Runs consistency sampling for several sigma schedules at once.
+
+        Every schedule gets its own copy of the batch and all copies start from the same
+        noise. The copies are stacked along the batch dimension, so the model is called
+        once per step of the longest schedule instead of once per step of every
+        schedule. Finished schedules keep running on their last sigma with the result
+        discarded, which keeps the batch size fixed across calls for compiled or
+        CUDA-graph captured models.
+
+        Parameters
+        ----------
+        model : nn.Module
+            Model to sample from.
+        noise : Tensor
+            Standard normal noise, scaled by the first sigma of each schedule.
+        v : Tensor
+            Conditioning images passed to the model.
+        sigmas_list : Sequence[Sequence[float]]
+            Decreasing standard deviations of the noise, one sequence per schedule.
+        clip_denoised : bool, default=False
+            Whether to clip denoised values to [-1, 1] range.
+        **kwargs : Any
+            Additional keyword arguments to be passed to the model.
+
+        Returns
+        -------
+        List[Tensor]
+            Sampled batch for each schedule, in the order of `sigmas_list`.
+        """
+        batch_size = noise.shape[0]
+        repeats = (len(sigmas_list),) + (1,) * (noise.ndim - 1)
+
+        # Order the schedules from longest to shortest so the ones still running
+        # always form a prefix of the stacked batch
+        order = sorted(range(len(sigmas_list)), key=lambda i: -len(sigmas_list[i]))
+        schedules = [sigmas_list[i] for i in order]
+        x = noise.repeat(repeats)
+        v = v.repeat(repeats)
+
+        for step in range(len(schedules[0])):
+            num_rows = batch_size * sum(len(sigmas) > step for sigmas in schedules)
+            sigma = torch.tensor(
+                [sigmas[min(step, len(sigmas) - 1)] for sigmas in schedules],
+                dtype=x.dtype,
+                device=x.device,
+            ).repeat_interleave(batch_size)
+
+            # The first step starts from pure noise, later ones re-noise the sample
+            x_step = x
+            if step == 0:
+                x_step = pad_dims_like(sigma, x_step) * x_step
+            else:
+                x_step = x_step + pad_dims_like(
+                    (sigma**2 - self.sigma_min**2) ** 0.5, x_step
+                ) * torch.randn_like(x_step)
+            x_step = model_forward_wrapper(
+                model,
+                x_step,
+                sigma,
+                v,
+                self.sigma_data,
+                self.sigma_min,
+                **kwargs,
+            )
+            if clip_denoised:
+                x_step = x_step.clamp(min=-1.0, max=1.0)
+            # Only keep the results of the schedules that are still running
+            x[:num_rows] = x_step[:num_rows]
+
+        samples = x.split(batch_size)
+        return [samples[order.index(i)] for i in range(len(sigmas_list))]
+
     def interpolate(
         self,
         model: nn.Module,
@@ -1,12 +1,11 @@
 import json
 import os
 from dataclasses import asdict, dataclass
-from typing import Any, Callable, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import torch
 from torchvision.transforms import functional as TF
 import math
-from einops import rearrange
 from einops.layers.torch import Rearrange
 from lightning import LightningDataModule, LightningModule, Trainer, seed_everything
 from lightning.pytorch.callbacks import LearningRateMonitor
@@ -18,41 +17,84 @@ from torch.utils.data import DataLoader
 from torchinfo import summary
 from torchvision import transforms as T
 from torchvision.datasets import ImageFolder
+from torchvision.io import ImageReadMode, decode_jpeg, read_file
 from torchvision.utils import make_grid
 
 from improved_consistency_model_conditional import (
     ConsistencySamplingAndEditing,
     ImprovedConsistencyTraining,
     pseudo_huber_loss,
-    update_ema_model_,
 )
 
 
 from torch.utils.data import Dataset
 from torchvision import transforms as T
+import glob
 import os
+import random
+import shutil
+from functools import partial
+import numpy as np
 from PIL import Image
 import torch
 from lightning.pytorch.callbacks import LearningRateMonitor, ModelCheckpoint
 from lightning.pytorch import LightningDataModule
 
+try:
+    from xformers.ops import memory_efficient_attention
+except ImportError:
+    memory_efficient_attention = None
+
+try:
+    import webdataset as wds
+except ImportError:
+    wds = None
+
+
+def augment_pair(
+    pair: Tuple[Image.Image, Image.Image],
+    crop_size: Tuple[int, int],
+    resize_size: Tuple[int, int],
+) -> Tuple[Tensor, Tensor]:
+    visible_image, infrared_image = pair
+
+    # Perform synchronized random crop, using the stdlib RNG rather than torch's
+    # in the workers
+    width, height = visible_image.size
+    i = random.randint(0, height - crop_size[0])
+    j = random.randint(0, width - crop_size[1])
+    visible_image = TF.crop(visible_image, i, j, *crop_size)
+    infrared_image = TF.crop(infrared_image, i, j, *crop_size)
+
+    # Resize to desired size while the images are still uint8
+    visible_image = TF.resize(visible_image, resize_size)
+    infrared_image = TF.resize(infrared_image, resize_size)
+
+    # Perform synchronized random horizontal flip
+    if random.random() > 0.5:
+        visible_image = visible_image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+        infrared_image = infrared_image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+
+    # Normalization to [-1, 1] happens on the device, see `on_after_batch_transfer`
+    return TF.pil_to_tensor(visible_image), TF.pil_to_tensor(infrared_image)
+
 
 class PairedDataset(Dataset):
     def __init__(
         self,
         visible_dir: str,
         infrared_dir: str,
-        transform: Optional[Callable] = None,
         crop_size: Tuple[int, int] = (512, 512),
-        resize_size: Tuple[int, int] = (256, 256)
+        resize_size: Tuple[int, int] = (256, 256),
+        decode: bool = True,
     ):
         self.visible_dir = visible_dir
         self.infrared_dir = infrared_dir
         self.visible_images = sorted(os.listdir(visible_dir))
         self.infrared_images = sorted(os.listdir(infrared_dir))
-        self.transform = transform
         self.crop_size = crop_size
         self.resize_size = resize_size
+        self.decode = decode
 
     def __len__(self) -> int:
         return len(self.visible_images)
@@ -61,32 +103,148 @@ class PairedDataset(Dataset):
         visible_path = os.path.join(self.visible_dir, self.visible_images[index])
         infrared_path = os.path.join(self.infrared_dir, self.infrared_images[index])
 
+        if not self.decode:
+            # Hand the encoded JPEGs over to be decoded with nvJPEG on the GPU
+            return read_file(visible_path), read_file(infrared_path)
+
         visible_image = Image.open(visible_path).convert("RGB")
         infrared_image = Image.open(infrared_path).convert("RGB")
 
         if visible_image.size != infrared_image.size:
             print(f"Skipping image pair at index {index} due to mismatched sizes")
             return None
-        
-        # Perform synchronized random horizontal flip
-        if torch.rand(1).item() > 0.5:
-            visible_image = TF.hflip(visible_image)
-            infrared_image = TF.hflip(infrared_image)
 
-        # Perform synchronized random crop
-        i, j, h, w = T.RandomCrop.get_params(visible_image, output_size=self.crop_size)
-        visible_image = TF.crop(visible_image, i, j, h, w)
-        infrared_image = TF.crop(infrared_image, i, j, h, w)
+        return augment_pair(
+            (visible_image, infrared_image), self.crop_size, self.resize_size
+        )
+
 
-        # Resize to desired size
-        visible_image = TF.resize(visible_image, self.resize_size)
-        infrared_image = TF.resize(infrared_image, self.resize_size)
+def write_paired_shards(
+    visible_dir: str, infrared_dir: str, shard_dir: str, max_count: int = 1000
+) -> None:
+    # Pack the pairs into tar shards that can be streamed sequentially
+    visible_images = sorted(os.listdir(visible_dir))
+    infrared_images = sorted(os.listdir(infrared_dir))
+    if not visible_images or len(visible_images) != len(infrared_images):
+        raise ValueError(
+            f"Cannot shard {len(visible_images)} visible and "
+            f"{len(infrared_images)} infrared images, expected equal non-zero counts"
+        )
+
+    # Write into a temporary directory so an interrupted run never leaves
+    # partial shards behind in `shard_dir`
+    tmp_dir = f"{shard_dir.rstrip(os.sep)}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    pattern = os.path.join(tmp_dir, "llvip-%06d.tar")
+    with wds.ShardWriter(pattern, maxcount=max_count) as sink:
+        for index, (visible_name, infrared_name) in enumerate(
+            zip(visible_images, infrared_images)
+        ):
+            visible_path = os.path.join(visible_dir, visible_name)
+            infrared_path = os.path.join(infrared_dir, infrared_name)
+            with Image.open(visible_path) as visible_image, Image.open(
+                infrared_path
+            ) as infrared_image:
+                if visible_image.size != infrared_image.size:
+                    raise ValueError(
+                        f"Image pair at index {index} has mismatched sizes "
+                        f"{visible_image.size} and {infrared_image.size}"
+                    )
+            with open(visible_path, "rb") as f:
+                visible_data = f.read()
+            with open(infrared_path, "rb") as f:
+                infrared_data = f.read()
+            sink.write(
+                {
+                    "__key__": f"{index:06d}",
+                    "visible.jpg": visible_data,
+                    "infrared.jpg": infrared_data,
+                }
+            )
+
+    os.replace(tmp_dir, shard_dir)
+
+
+def _encoded_to_tensor(data: bytes) -> Tensor:
+    return torch.frombuffer(bytearray(data), dtype=torch.uint8)
+
+
+def cache_paired_images(
+    visible_dir: str,
+    infrared_dir: str,
+    cache_path: str,
+    scale: Tuple[float, float],
+) -> None:
+    # Store every full frame pair, already resized by `scale`, in a single
+    # (N, 2, 3, H, W) uint8 array so training crops can skip decoding entirely
+    visible_images = sorted(os.listdir(visible_dir))
+    infrared_images = sorted(os.listdir(infrared_dir))
+    if not visible_images or len(visible_images) != len(infrared_images):
+        raise ValueError(
+            f"Cannot cache {len(visible_images)} visible and "
+            f"{len(infrared_images)} infrared images, expected equal non-zero counts"
+        )
+
+    cache = None
+    tmp_path = f"{cache_path}.tmp"
+    for index, (visible_name, infrared_name) in enumerate(
+        zip(visible_images, infrared_images)
+    ):
+        visible_image = Image.open(os.path.join(visible_dir, visible_name)).convert("RGB")
+        infrared_image = Image.open(os.path.join(infrared_dir, infrared_name)).convert("RGB")
+
+        width, height = visible_image.size
+        size = [round(height * scale[0]), round(width * scale[1])]
+        if cache is None:
+            cache = np.lib.format.open_memmap(
+                tmp_path,
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(visible_images), 2, 3, *size),
+            )
+        if visible_image.size != infrared_image.size or list(cache.shape[-2:]) != size:
+            raise ValueError(
+                f"Image pair at index {index} does not match the size of the first pair"
+            )
 
-        if self.transform:
-            visible_image = self.transform(visible_image)
-            infrared_image = self.transform(infrared_image)
+        cache[index, 0] = TF.pil_to_tensor(TF.resize(visible_image, size)).numpy()
+        cache[index, 1] = TF.pil_to_tensor(TF.resize(infrared_image, size)).numpy()
 
-        return visible_image, infrared_image
+    cache.flush()
+    del cache
+    os.replace(tmp_path, cache_path)
+
+
+class CachedPairedDataset(Dataset):
+    def __init__(self, cache_path: str, crop_size: Tuple[int, int] = (128, 128)):
+        self.cache_path = cache_path
+        self.crop_size = crop_size
+        self.length = len(np.load(cache_path, mmap_mode="r"))
+        # Opened lazily so every worker maps the file instead of receiving a copy
+        self.images = None
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> Tuple[Tensor, Tensor]:
+        if self.images is None:
+            self.images = np.load(self.cache_path, mmap_mode="r")
+
+        # Perform synchronized random crop, the images are already resized
+        height, width = self.images.shape[-2:]
+        i = random.randint(0, height - self.crop_size[0])
+        j = random.randint(0, width - self.crop_size[1])
+        pair = self.images[index, :, :, i : i + self.crop_size[0], j : j + self.crop_size[1]]
+        pair = torch.from_numpy(np.ascontiguousarray(pair))
+
+        return pair[0], pair[1]
+
+
+def collate_encoded_pairs(batch: List[Tuple[Tensor, Tensor]]) -> List[List[Tensor]]:
+    # Encoded JPEGs differ in length, keep them as lists rather than stacking
+    return [list(images) for images in zip(*batch)]
 
 
 @dataclass
@@ -98,26 +256,87 @@ class ImageDataModuleConfig:
     num_workers: int = 8  # Number of worker threads for data loading
     pin_memory: bool = True  # Whether to pin memory in data loader
     persistent_workers: bool = True  # Keep workers alive between epochs
+    decode_on_gpu: bool = True  # Decode and augment with nvJPEG instead of PIL workers
+    # Opt-in pre-resized uint8 .npy cache, built single-threaded on first use. It keeps
+    # full frames scaled by resize/crop, about 5.9 GB for the LLVIP train split
+    cache_path: Optional[str] = None
+    shard_dir: Optional[str] = None  # WebDataset tar shards, written if missing
+    shuffle_buffer_size: int = 1000  # Samples shuffled in memory when streaming shards
 
 
 class LLVIPDataModule(LightningDataModule):
     def __init__(self, config: ImageDataModuleConfig) -> None:
         super().__init__()
         self.config = config
+        self.visible_dir = "datasets/LLVIP/visible/train"
+        self.infrared_dir = "datasets/LLVIP/infrared/train"
+
+        # The cache replaces decoding entirely, otherwise JPEGs are either decoded
+        # by the workers or on the device
+        self.use_cache = config.cache_path is not None
+        self.use_shards = config.shard_dir is not None and not self.use_cache
+        if self.use_shards and wds is None:
+            raise ImportError("Streaming from `shard_dir` requires webdataset")
+        self.decode_on_device = config.decode_on_gpu and not self.use_cache
+        self.flip_on_device = config.decode_on_gpu or self.use_cache
+
+    def prepare_data(self) -> None:
+        if self.use_cache and not os.path.exists(self.config.cache_path):
+            crop_size = self.config.image_size_crop
+            resize_size = self.config.image_size_resize
+            cache_paired_images(
+                self.visible_dir,
+                self.infrared_dir,
+                self.config.cache_path,
+                scale=(resize_size[0] / crop_size[0], resize_size[1] / crop_size[1]),
+            )
+
+        if self.use_shards and not self._shards():
+            write_paired_shards(
+                self.visible_dir, self.infrared_dir, self.config.shard_dir
+            )
 
     def setup(self, stage: str = None) -> None:
-        # Define transforms excluding cropping and resizing
-        self.transform = T.Compose([
-            T.ToTensor(),
-            T.Lambda(lambda x: (x * 2) - 1),  # Normalize to [-1, 1]
-        ])
+        if self.use_cache:
+            self.dataset = CachedPairedDataset(
+                self.config.cache_path, crop_size=self.config.image_size_resize
+            )
+            return
+
+        if self.use_shards:
+            # Every worker of every rank resamples shards for the same number of
+            # whole batches, so DDP ranks never run out of data at different steps
+            world_size = self.trainer.world_size if self.trainer is not None else 1
+            num_workers = max(self.config.num_workers, 1)
+            batch_size = self.config.batch_size
+            num_batches = len(os.listdir(self.visible_dir)) // (
+                world_size * num_workers * batch_size
+            )
+            dataset = wds.WebDataset(self._shards(), resampled=True).shuffle(
+                self.config.shuffle_buffer_size
+            )
+            if self.decode_on_device:
+                dataset = dataset.to_tuple("visible.jpg", "infrared.jpg").map_tuple(
+                    _encoded_to_tensor, _encoded_to_tensor
+                )
+            else:
+                dataset = dataset.decode("pilrgb").to_tuple("visible.jpg", "infrared.jpg")
+                dataset = dataset.map(
+                    partial(
+                        augment_pair,
+                        crop_size=self.config.image_size_crop,
+                        resize_size=self.config.image_size_resize,
+                    )
+                )
+            self.dataset = dataset.with_epoch(num_batches * batch_size)
+            return
 
         self.dataset = PairedDataset(
-        visible_dir="datasets/LLVIP/visible/train",
-        infrared_dir="datasets/LLVIP/infrared/train",
-        transform=self.transform,
+        visible_dir=self.visible_dir,
+        infrared_dir=self.infrared_dir,
         crop_size=self.config.image_size_crop,
-        resize_size=self.config.image_size_resize
+        resize_size=self.config.image_size_resize,
+        decode=not self.decode_on_device,
         )
 
 
@@ -125,18 +344,89 @@ class LLVIPDataModule(LightningDataModule):
         return DataLoader(
             self.dataset,
             batch_size=self.config.batch_size,
-            shuffle=True,
+            # Streamed shards are shuffled by the WebDataset pipeline itself
+            shuffle=not self.use_shards,
+            # Keep every batch the same shape for the static compile and cuDNN benchmark
+            drop_last=True,
             num_workers=self.config.num_workers,
             pin_memory=self.config.pin_memory,
             persistent_workers=self.config.persistent_workers,
+            collate_fn=collate_encoded_pairs if self.decode_on_device else None,
+        )
+
+    def _shards(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.config.shard_dir, "*.tar")))
+
+    def on_before_batch_transfer(
+        self, batch: List[Any], dataloader_idx: int
+    ) -> List[Tensor]:
+        if not self.decode_on_device:
+            return batch
+
+        device = self.trainer.strategy.root_device
+        visible_images = decode_jpeg(batch[0], mode=ImageReadMode.RGB, device=device)
+        infrared_images = decode_jpeg(batch[1], mode=ImageReadMode.RGB, device=device)
+
+        # Perform synchronized random crops
+        visible_crops, infrared_crops = [], []
+        h, w = self.config.image_size_crop
+        for index, (visible_image, infrared_image) in enumerate(
+            zip(visible_images, infrared_images)
+        ):
+            if visible_image.shape != infrared_image.shape:
+                raise ValueError(
+                    f"Image pair at batch index {index} has mismatched shapes "
+                    f"{tuple(visible_image.shape)} and {tuple(infrared_image.shape)}"
+                )
+            i = random.randint(0, visible_image.shape[-2] - h)
+            j = random.randint(0, visible_image.shape[-1] - w)
+            visible_crops.append(visible_image[:, i : i + h, j : j + w])
+            infrared_crops.append(infrared_image[:, i : i + h, j : j + w])
+
+        # Resize both modalities in one call, values stay in [0, 255]
+        images = torch.stack(visible_crops + infrared_crops).float()
+        images = F.interpolate(
+            images,
+            size=self.config.image_size_resize,
+            mode="bilinear",
+            antialias=True,
         )
 
+        return list(images.chunk(2))
+
+    def on_after_batch_transfer(
+        self, batch: List[Tensor], dataloader_idx: int
+    ) -> List[Tensor]:
+        visible_images, infrared_images = batch
+
+        # Perform synchronized random horizontal flip
+        if self.flip_on_device:
+            flip = torch.rand(visible_images.shape[0], device=visible_images.device)
+            flip = (flip > 0.5)[:, None, None, None]
+            visible_images = torch.where(flip, visible_images.flip(-1), visible_images)
+            infrared_images = torch.where(flip, infrared_images.flip(-1), infrared_images)
+
+        # Normalize the [0, 255] images to [-1, 1] once they are on the device
+        return [
+            images.float().mul_(2 / 255).sub_(1)
+            for images in (visible_images, infrared_images)
+        ]
 
 
 def GroupNorm(channels: int) -> nn.GroupNorm:
     return nn.GroupNorm(num_groups=min(32, channels // 4), num_channels=channels)
 
 
+def _rename_legacy_keys(
+    state_dict: Dict[str, Tensor], prefix: str, renames: Dict[str, str]
+) -> None:
+    # Checkpoints saved before a module was restructured still use the old
+    # parameter names, rename them in place so they keep loading
+    for old, new in renames.items():
+        for key in [key for key in state_dict if key.startswith(prefix + old)]:
+            state_dict[prefix + new + key[len(prefix + old) :]] = state_dict.pop(key)
+
+
 class SelfAttention(nn.Module):
     def __init__(
         self,
@@ -148,32 +438,56 @@ class SelfAttention(nn.Module):
         super().__init__()
 
         self.dropout = dropout
-
-        self.qkv_projection = nn.Sequential(
-            GroupNorm(in_channels),
-            nn.Conv2d(in_channels, 3 * in_channels, kernel_size=1, bias=False),
-            Rearrange("b (i h d) x y -> i b h (x y) d", i=3, h=n_heads),
-        )
-        self.output_projection = nn.Sequential(
-            Rearrange("b h l d -> b l (h d)"),
-            nn.Linear(in_channels, out_channels, bias=False),
-            Rearrange("b l d -> b d l"),
-            GroupNorm(out_channels),
-            nn.Dropout1d(dropout),
-        )
+        self.n_heads = n_heads
+        self.d_head = in_channels // n_heads
+
+        self.gn = GroupNorm(in_channels)
+        self.qkv = nn.Conv2d(in_channels, 3 * in_channels, kernel_size=1, bias=False)
+        self.linear = nn.Linear(in_channels, out_channels, bias=False)
+        self.gn_out = GroupNorm(out_channels)
+        self.drop = nn.Dropout1d(dropout)
         self.residual_projection = nn.Conv2d(in_channels, out_channels, kernel_size=1)
 
     def forward(self, x: Tensor) -> Tensor:
-        q, k, v = self.qkv_projection(x).unbind(dim=0)
+        batch_size, _, height, width = x.shape
+        dropout = self.dropout if self.training else 0.0
 
-        output = F.scaled_dot_product_attention(
-            q, k, v, dropout_p=self.dropout if self.training else 0.0, is_causal=False
+        # b (i h d) x y -> b (x y) i h d, the packed layout xFormers expects
+        qkv = self.qkv(self.gn(x)).view(
+            batch_size, 3, self.n_heads, self.d_head, height * width
         )
-        output = self.output_projection(output)
-        output = rearrange(output, "b c (x y) -> b c x y", x=x.shape[-2], y=x.shape[-1])
+        qkv = qkv.permute(0, 4, 1, 2, 3).contiguous()
+
+        if memory_efficient_attention is not None and x.is_cuda:
+            q, k, v = qkv.unbind(dim=2)
+            output = memory_efficient_attention(q, k, v, p=dropout)
+        else:
+            q, k, v = qkv.transpose(1, 3).unbind(dim=2)
+            output = F.scaled_dot_product_attention(
+                q, k, v, dropout_p=dropout, is_causal=False
+            )
+            output = output.transpose(1, 2)
+
+        # b l h d -> b l (h d) -> b c l -> b c x y
+        output = self.linear(output.reshape(batch_size, height * width, -1))
+        output = self.drop(self.gn_out(output.transpose(1, 2)))
+        output = output.view(batch_size, -1, height, width)
 
         return output + self.residual_projection(x)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        _rename_legacy_keys(
+            state_dict,
+            prefix,
+            {
+                "qkv_projection.0.": "gn.",
+                "qkv_projection.1.": "qkv.",
+                "output_projection.1.": "linear.",
+                "output_projection.3.": "gn_out.",
+            },
+        )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class UNetBlock(nn.Module):
     def __init__(
@@ -236,33 +550,45 @@ class Downsample(nn.Module):
     def __init__(self, channels: int) -> None:
         super().__init__()
 
-        self.projection = nn.Sequential(
-            Rearrange("b c (h ph) (w pw) -> b (c ph pw) h w", ph=2, pw=2),
-            nn.Conv2d(4 * channels, channels, kernel_size=1),
-        )
+        self.conv = nn.Conv2d(4 * channels, channels, kernel_size=1)
 
     def forward(self, x: Tensor) -> Tensor:
-        return self.projection(x)
+        # b c (h ph) (w pw) -> b (c ph pw) h w
+        return self.conv(F.pixel_unshuffle(x, 2))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        _rename_legacy_keys(state_dict, prefix, {"projection.1.": "conv."})
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 class Upsample(nn.Module):
     def __init__(self, channels: int) -> None:
         super().__init__()
 
-        self.projection = nn.Sequential(
-            nn.Upsample(scale_factor=2.0, mode="nearest"),
-            nn.Conv2d(channels, channels, kernel_size=3, padding="same"),
-        )
+        self.conv = nn.Conv2d(channels, channels, kernel_size=3, padding="same")
 
     def forward(self, x: Tensor) -> Tensor:
-        return self.projection(x)
+        return self.conv(F.interpolate(x, scale_factor=2.0, mode="nearest"))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        _rename_legacy_keys(state_dict, prefix, {"projection.1.": "conv."})
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def _sinusoidal_embedding(x: Tensor, W2pi: Tensor) -> Tensor:
+    # Left uncompiled so eager use (e.g. evaluation) never needs Inductor, the
+    # compiled UNet in `run_training` inlines and fuses it into one kernel
+    h = x.unsqueeze(1) * W2pi.unsqueeze(0)
+    return torch.cat((h.sin(), h.cos()), dim=-1)
 
 
 class NoiseLevelEmbedding(nn.Module):
     def __init__(self, channels: int, scale: float = 0.02) -> None:
         super().__init__()
 
-        self.W = nn.Parameter(torch.randn(channels // 2) * scale, requires_grad=False)
+        self.register_buffer(
+            "W2pi", torch.randn(channels // 2) * scale * 2 * math.pi
+        )
 
         self.projection = nn.Sequential(
             nn.Linear(channels, 4 * channels),
@@ -272,10 +598,14 @@ class NoiseLevelEmbedding(nn.Module):
         )
 
     def forward(self, x: Tensor) -> Tensor:
-        h = x[:, None] * self.W[None, :] * 2 * torch.pi
-        h = torch.cat([torch.sin(h), torch.cos(h)], dim=-1)
+        return self.projection(_sinusoidal_embedding(x, self.W2pi))
 
-        return self.projection(h)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        # Older checkpoints store the raw frequencies as a frozen `W` parameter
+        W = state_dict.pop(prefix + "W", None)
+        if W is not None:
+            state_dict[prefix + "W2pi"] = W * 2 * math.pi
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 @dataclass
@@ -300,12 +630,35 @@ class UNet(nn.Module):
 
         self.config = config
 
-        self.input_projection = nn.Conv2d(
+        # Equivalent to a single conv over torch.cat([x, v], dim=1), without
+        # materializing the concatenated input
+        self.input_projection_x = nn.Conv2d(
+            config.channels,
+            config.top_blocks_channels[0],
+            kernel_size=3,
+            padding="same",
+        )
+        self.input_projection_v = nn.Conv2d(
+            config.channels,
+            config.top_blocks_channels[0],
+            kernel_size=3,
+            padding="same",
+            bias=False,
+        )
+        # Initialize both halves from the single conv so they keep its fan-in
+        input_projection = nn.Conv2d(
             config.channels * 2,
             config.top_blocks_channels[0],
             kernel_size=3,
             padding="same",
         )
+        weight_x, weight_v = input_projection.weight.detach().split(
+            config.channels, dim=1
+        )
+        with torch.no_grad():
+            self.input_projection_x.weight.copy_(weight_x)
+            self.input_projection_x.bias.copy_(input_projection.bias)
+            self.input_projection_v.weight.copy_(weight_v)
         self.noise_level_embedding = NoiseLevelEmbedding(
             config.noise_level_channels, config.noise_level_scale
         )
@@ -344,36 +697,42 @@ class UNet(nn.Module):
             padding="same",
         )
 
+        # Mark the blocks that take part in skip connections once, so forward
+        # has no isinstance checks for torch.compile to break the graph on
+        self.top_encoder_has_skip = self._has_skip(self.top_encoder_blocks)
+        self.mid_encoder_has_skip = self._has_skip(self.mid_encoder_blocks)
+        self.mid_decoder_has_skip = self._has_skip(self.mid_decoder_blocks)
+        self.top_decoder_has_skip = self._has_skip(self.top_decoder_blocks)
+
     def forward(self, x: Tensor, noise_level: Tensor, v: Tensor) -> Tensor:
-        x = torch.cat([x, v], dim = 1)
-        h = self.input_projection(x)
+        h = self.input_projection_x(x) + self.input_projection_v(v)
         noise_level = self.noise_level_embedding(noise_level)
 
         top_encoder_embeddings = []
-        for block in self.top_encoder_blocks:
-            if isinstance(block, UNetBlock):
+        for has_skip, block in zip(self.top_encoder_has_skip, self.top_encoder_blocks):
+            if has_skip:
                 h = block(h, noise_level)
                 top_encoder_embeddings.append(h)
             else:
                 h = block(h)
 
         mid_encoder_embeddings = []
-        for block in self.mid_encoder_blocks:
-            if isinstance(block, UNetBlockWithSelfAttention):
+        for has_skip, block in zip(self.mid_encoder_has_skip, self.mid_encoder_blocks):
+            if has_skip:
                 h = block(h, noise_level)
                 mid_encoder_embeddings.append(h)
             else:
                 h = block(h)
 
-        for block in self.mid_decoder_blocks:
-            if isinstance(block, UNetBlockWithSelfAttention):
+        for has_skip, block in zip(self.mid_decoder_has_skip, self.mid_decoder_blocks):
+            if has_skip:
                 h = torch.cat((h, mid_encoder_embeddings.pop()), dim=1)
                 h = block(h, noise_level)
             else:
                 h = block(h)
 
-        for block in self.top_decoder_blocks:
-            if isinstance(block, UNetBlock):
+        for has_skip, block in zip(self.top_decoder_has_skip, self.top_decoder_blocks):
+            if has_skip:
                 h = torch.cat((h, top_encoder_embeddings.pop()), dim=1)
                 h = block(h, noise_level)
             else:
@@ -383,6 +742,26 @@ class UNet(nn.Module):
 
         return output
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        # Older checkpoints hold a single conv over the concatenated inputs,
+        # split its weight along the input channels
+        weight = state_dict.pop(prefix + "input_projection.weight", None)
+        if weight is not None:
+            weight_x, weight_v = weight.split(self.config.channels, dim=1)
+            state_dict[prefix + "input_projection_x.weight"] = weight_x
+            state_dict[prefix + "input_projection_v.weight"] = weight_v
+            _rename_legacy_keys(
+                state_dict, prefix, {"input_projection.": "input_projection_x."}
+            )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @staticmethod
+    def _has_skip(blocks: nn.ModuleList) -> Tuple[bool, ...]:
+        return tuple(
+            isinstance(block, (UNetBlock, UNetBlockWithSelfAttention))
+            for block in blocks
+        )
+
     def _make_encoder_blocks(
         self,
         channels: Tuple[int, ...],
@@ -514,11 +893,18 @@ class LitImprovedConsistencyModel(LightningModule):
             param.requires_grad = False
         self.ema_model = self.ema_model.eval()
 
+        # Parameters keep their identity across device moves and compile, so the
+        # lists for the EMA update are only built once
+        self._ema_params = list(self.ema_model.parameters())
+        self._online_params = list(self.model.parameters())
+
     def training_step(self, batch: Union[Tensor, List[Tensor]], batch_idx: int) -> None:
         # if isinstance(batch, list):
         #     batch = batch[0]
 
         visible_images, infrared_images = batch  # Unpack the batch
+        visible_images = visible_images.to(memory_format=torch.channels_last)
+        infrared_images = infrared_images.to(memory_format=torch.channels_last)
 
         output = self.consistency_training(
             self.model, 
@@ -539,7 +925,14 @@ class LitImprovedConsistencyModel(LightningModule):
     def on_train_batch_end(
         self, outputs: Any, batch: Union[Tensor, List[Tensor]], batch_idx: int
     ) -> None:
-        update_ema_model_(self.model, self.ema_model, self.config.ema_decay_rate)
+        # One multi-tensor lerp for all parameters instead of one kernel each
+        weight = 1.0 - self.config.ema_decay_rate
+        with torch.no_grad():
+            torch._foreach_lerp_(self._ema_params, self._online_params, weight)
+            # Buffers are replaced on device moves, so they are listed every step
+            torch._foreach_lerp_(
+                list(self.ema_model.buffers()), list(self.model.buffers()), weight
+            )
 
         if (
             (self.global_step + 1) % self.config.sample_every_n_steps == 0
@@ -559,24 +952,28 @@ class LitImprovedConsistencyModel(LightningModule):
 
         return [opt], [sched]
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def __sample_and_log_samples(self, batch: Union[Tensor, List[Tensor]]) -> None:
-        if isinstance(batch, list):
-            batch = batch[0]
+        visible_images, infrared_images = batch
 
         # Ensure the number of samples does not exceed the batch size
-        num_samples = min(self.config.num_samples, batch.shape[0])
-        noise = torch.randn_like(batch[:num_samples])
+        num_samples = min(self.config.num_samples, visible_images.shape[0])
+        noise = torch.randn_like(infrared_images[:num_samples])
 
         # Log ground truth samples
         self.__log_images(
-            batch[:num_samples].detach().clone(), f"ground_truth", self.global_step
+            infrared_images[:num_samples], f"ground_truth", self.global_step
         )
 
-        for sigmas in self.config.sampling_sigmas:
-            samples = self.consistency_sampling(
-                self.ema_model, noise, sigmas, clip_denoised=True, verbose=True
-            )
+        # All schedules are sampled together, one EMA call per step
+        all_samples = self.consistency_sampling.sample_schedules(
+            self.ema_model,
+            noise,
+            visible_images[:num_samples],
+            self.config.sampling_sigmas,
+            clip_denoised=True,
+        )
+        for sigmas, samples in zip(self.config.sampling_sigmas, all_samples):
             samples = samples.clamp(min=-1.0, max=1.0)
 
             # Generated samples
@@ -612,15 +1009,24 @@ def run_training(config: TrainingConfig) -> None:
     seed_everything(config.seed)
 
     # Create data module
+    # `Trainer.fit` runs `prepare_data` on local rank 0 only and then `setup`
     dm = LLVIPDataModule(config.image_dm_config)
-    dm.setup()
-    print("DataModule setup complete.")
+    print("DataModule created.")
 
     # Create model and its EMA
     model = UNet(config.unet_config)
     ema_model = UNet(config.unet_config)
     ema_model.load_state_dict(model.state_dict())
 
+    # NHWC lets cuDNN pick its Tensor Core convolution kernels
+    model = model.to(memory_format=torch.channels_last)
+    ema_model = ema_model.to(memory_format=torch.channels_last)
+
+    # Compile in place so Inductor fuses the GroupNorm/SiLU/Conv epilogues and
+    # residual adds; in-place compilation keeps the state dict keys unprefixed
+    model.compile(mode="max-autotune-no-cudagraphs", dynamic=False)
+    ema_model.compile(mode="reduce-overhead", dynamic=False)
+
     # Create lightning module
     lit_icm = LitImprovedConsistencyModel(
         config.consistency_training,
@@ -643,6 +1049,12 @@ def run_training(config: TrainingConfig) -> None:
 
 # Main function
 def main():
+    # Input shapes are fixed, so let cuDNN benchmark and cache its conv algorithms
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     # Define the checkpoint callback
     checkpoint_callback = ModelCheckpoint(
         dirpath="checkpoints_512x512_128x128",
@@ -664,7 +1076,7 @@ def main():
         ),
         trainer=Trainer(
             max_steps=200000,
-            precision="16",
+            precision="bf16-mixed",
             log_every_n_steps=10,
             logger=logger,
             callbacks=[